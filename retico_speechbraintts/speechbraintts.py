@@ -1,37 +1,143 @@
 from email.mime import audio
+import collections
+import logging
 import os
+import queue
+import tempfile
 import threading
 import time
+import warnings
 from hashlib import blake2b
 
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 import retico_core
 from speechbrain.pretrained import Tacotron2
 from speechbrain.pretrained import HIFIGAN
 import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def _f32_to_i16(waveform, out):
+        """Clips, scales, rounds and casts float32 data [-1,1] to int16 data
+        [-32767,32767] in a single pass. NaNs are converted to 0. The arithmetic
+        is done in float32 to give the same results as the NumPy fallback."""
+        one = np.float32(1.0)
+        scale = np.float32(32767.0)
+        for i in prange(waveform.shape[0]):
+            v = waveform[i]
+            if v != v:
+                v = np.float32(0.0)
+            elif v > one:
+                v = one
+            elif v < -one:
+                v = -one
+            out[i] = np.int16(np.rint(v * scale))
+
+else:
+    _f32_to_i16 = None
+
+
+logger = logging.getLogger(__name__)
 
 
 class SpeechBrainTTS:
+    MIN_MEL_LENGTH = 880
+    MEL_BUCKET_SIZE = 256
+
     def __init__(
         self,
         tacotron_model="speechbrain/tts-tacotron2-ljspeech",
         hifi_model="speechbrain/tts-hifigan-ljspeech",
         tmp_dir="~/.cache",
         caching=True,
+        device=None,
+        half_precision=None,
+        mem_cache_size=32,
+        compile_models=False,
+        pad_mels=None,
+        cudnn_benchmark=False,
     ):
         self.tacotron_model = tacotron_model
         self.hifi_model = hifi_model
         self.tmp_dir = tmp_dir.replace("~", os.path.expanduser("~"))
         self.caching = caching
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        if half_precision is None:
+            half_precision = self.device.startswith("cuda")
+        self.half_precision = half_precision
+        self._autocast_device = "cuda" if self.device.startswith("cuda") else "cpu"
+        self._autocast_dtype = (
+            torch.float16 if self._autocast_device == "cuda" else torch.bfloat16
+        )
+        if pad_mels is None:
+            pad_mels = self.device.startswith("cuda")
+        self.pad_mels = pad_mels
+        self._host_buf = None
         self.caching_dir = os.path.join(self.tmp_dir, "sbcache")
         if not os.path.exists(self.caching_dir):
             os.makedirs(self.caching_dir)
+        # The model identifiers are fixed, so their part of the cache key is only
+        # encoded once.
+        self._model_key = (tacotron_model + hifi_model).encode("utf-8")
+        self._cache_prefix = os.path.join(self.caching_dir, "")
+        self.mem_cache_size = mem_cache_size
+        self._mem_cache = collections.OrderedDict()
+        self._cached = set()
+        self.refresh_cache_index()
 
         self.tacotron2 = Tacotron2.from_hparams(
-            source=tacotron_model, savedir=os.path.join(self.tmp_dir, "sb_tts")
+            source=tacotron_model,
+            savedir=os.path.join(self.tmp_dir, "sb_tts"),
+            run_opts={"device": self.device},
         )
         self.hifi_gan = HIFIGAN.from_hparams(
-            source=hifi_model, savedir=os.path.join(self.tmp_dir, "sb_vocoder")
+            source=hifi_model,
+            savedir=os.path.join(self.tmp_dir, "sb_vocoder"),
+            run_opts={"device": self.device},
         )
+        if _f32_to_i16 is not None:
+            # Compile the PCM kernel now instead of during the first synthesis
+            self._to_int16(np.zeros(1, dtype=np.float32))
+        # Make sure dropout and batch norm layers are in inference mode
+        self.tacotron2.mods.eval()
+        self.hifi_gan.mods.eval()
+
+        if cudnn_benchmark and self.device.startswith("cuda"):
+            # This is a process-wide setting that also affects other models.
+            torch.backends.cudnn.benchmark = True
+        compiled = False
+        if compile_models and hasattr(torch, "compile"):
+            # Only the vocoder is compiled. The autoregressive Tacotron2 decoder
+            # stops on a data-dependent condition and does not compile well.
+            self.hifi_gan.infer = torch.compile(
+                self.hifi_gan.hparams.generator.inference, dynamic=True
+            )
+            compiled = True
+        elif compile_models:
+            warnings.warn(
+                "compile_models requires torch>=2.0 (found %s), the models are not"
+                " compiled." % torch.__version__
+            )
+        if compiled or self.device.startswith("cuda"):
+            # Warm up the kernels (and the compiled graph) with dummy inputs so
+            # that the first real synthesis is not slowed down.
+            for _ in range(2):
+                self._infer(["This is a warm up sentence."])
 
     def get_cache_path(self, text):
         """
@@ -44,45 +150,222 @@ class SpeechBrainTTS:
         Returns (str): Path to a cached version of that synthesis.
 
         """
-        h = blake2b(digest_size=16)
-        h.update(bytes(text, "utf-8"))
-        h.update(bytes(self.tacotron_model, "utf-8"))
-        h.update(bytes(self.hifi_model, "utf-8"))
-        text_digest = h.hexdigest()
+        return self._cache_prefix + self.get_digest(text)
 
-        return os.path.join(self.caching_dir, text_digest)
+    def get_digest(self, text):
+        """
+        Creates a hash of the given text and the TTS settings that is used as the
+        key for both the in-memory and the on-disk cache.
+
+        Args:
+            text (str): The text to synthesis
 
-    def synthesize(self, text):
+        Returns (str): The hex digest of the text and the TTS settings.
+
+        """
+        if blake3 is not None:
+            # BLAKE3 digests are prefixed so that they do not collide with the
+            # BLAKE2b digests of existing cache files.
+            h = blake3(text.encode("utf-8"))
+            h.update(self._model_key)
+            return "b3" + h.hexdigest(length=16)
+
+        h = blake2b(text.encode("utf-8"), digest_size=16)
+        h.update(self._model_key)
+
+        return h.hexdigest()
+
+    def _remember(self, digest, waveform):
+        """Stores the waveform in the in-memory cache and evicts the least
+        recently used entry if the cache is full."""
+        if self.mem_cache_size <= 0:
+            return
+        self._mem_cache[digest] = waveform
+        self._mem_cache.move_to_end(digest)
+        if len(self._mem_cache) > self.mem_cache_size:
+            self._mem_cache.popitem(last=False)
+
+    def synthesize(self, text, as_array=False):
         """Takes the given text and returns the synthesized speech as 22050 Hz
         int16-encoded numpy ndarray.
 
         Args:
             text (str): The speech to synthesize/
+            as_array (bool): Whether to return the speech as an int16 numpy
+                ndarray instead of bytes. Cached syntheses are then memory-mapped
+                instead of being read into memory. The returned array is
+                read-only.
 
         Returns:
-            bytes: The speech as a 22050 Hz int16-encoded numpy ndarray
+            bytes or np.ndarray: The speech as 22050 Hz int16-encoded bytes, or
+            with `as_array` as a read-only int16 numpy ndarray (an np.memmap if
+            the synthesis was read from the on-disk cache).
         """
+        return self.synthesize_batch([text], as_array=as_array)[0]
 
-        cache_path = self.get_cache_path(text)
-        if self.caching and os.path.isfile(cache_path):
-            with open(cache_path, "rb") as cfile:
-                wav_audio = cfile.read()
-                return wav_audio
+    def synthesize_batch(self, texts, as_array=False):
+        """Takes the given texts and returns the synthesized speech for each of
+        them. All texts that are not cached are synthesized together in one
+        batch.
 
-        mel_output, _, _ = self.tacotron2.encode_text(text)
-
-        # Running Vocoder (spectrogram-to-waveform)
-        waveforms = self.hifi_gan.decode_batch(mel_output)
-
-        waveform = waveforms.squeeze(1).detach().numpy()[0]
-
-        # Convert float32 data [-1,1] to int16 data [-32767,32767]
-        waveform = (waveform * 32767).astype(np.int16).tobytes()
+        Args:
+            texts (list): The speech to synthesize.
+            as_array (bool): Whether to return the speech as int16 numpy ndarrays
+                instead of bytes (see `synthesize`).
 
-        if self.caching:
-            with open(cache_path, "wb") as cfile:
+        Returns:
+            list: The speech for each text in the same order as the texts, as
+            bytes or, with `as_array`, as read-only int16 numpy ndarrays or
+            np.memmaps (see `synthesize`).
+        """
+        digests = [self.get_digest(text) for text in texts]
+        waveforms = {}
+        missing = []
+        for text, digest in zip(texts, digests):
+            if digest in waveforms:
+                continue
+            waveforms[digest] = self._lookup(digest)
+            if waveforms[digest] is None:
+                missing.append((text, digest))
+
+        if missing:
+            # Tacotron2 requires the batch to be sorted by decreasing length
+            missing.sort(
+                key=lambda m: self.tacotron2.text_to_seq(m[0])[1], reverse=True
+            )
+            new_waveforms = self._infer([text for text, _ in missing])
+            for (_, digest), waveform in zip(missing, new_waveforms):
+                if self.caching:
+                    self._write_cache(digest, waveform)
+                self._remember(digest, waveform)
+                waveforms[digest] = waveform
+
+        if as_array:
+            return [waveforms[digest] for digest in digests]
+        return [waveforms[digest].tobytes() for digest in digests]
+
+    def _lookup(self, digest):
+        """Returns the cached synthesis for the given digest from the in-memory or
+        the on-disk cache or None if it is not cached."""
+        waveform = self._mem_cache.get(digest)
+        if waveform is not None:
+            self._mem_cache.move_to_end(digest)
+            return waveform
+
+        if self.caching and digest in self._cached:
+            cache_path = self._cache_prefix + digest
+            try:
+                waveform = np.memmap(cache_path, dtype=np.int16, mode="r")
+            except (OSError, ValueError):
+                try:
+                    empty = os.path.getsize(cache_path) == 0
+                except OSError:
+                    empty = False
+                if not empty:
+                    # The file has been removed or is corrupt, so the text is
+                    # synthesized again.
+                    self._cached.discard(digest)
+                    return None
+                # Empty files cannot be memory-mapped
+                waveform = np.empty(0, dtype=np.int16)
+            self._remember(digest, waveform)
+            return waveform
+
+        return None
+
+    def _write_cache(self, digest, waveform):
+        """Writes the waveform to the on-disk cache. The file is written under a
+        temporary name and then moved into place, so that other readers never
+        see a partially written file."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.caching_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as cfile:
                 cfile.write(waveform)
+            os.replace(tmp_path, self._cache_prefix + digest)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._cached.add(digest)
+
+    def refresh_cache_index(self):
+        """Rebuilds the index of the syntheses in the on-disk cache. This only
+        has to be called if other processes write to the cache directory."""
+        with os.scandir(self.caching_dir) as entries:
+            self._cached = {entry.name for entry in entries if entry.is_file()}
+
+    def _infer(self, texts):
+        """Runs Tacotron2 and HiFi-GAN on a batch of texts that is sorted by
+        decreasing length and returns the int16 waveform of each text."""
+        with torch.inference_mode(), torch.autocast(
+            device_type=self._autocast_device,
+            dtype=self._autocast_dtype,
+            enabled=self.half_precision,
+        ):
+            mel_outputs, mel_lengths, _ = self.tacotron2.encode_batch(texts)
+
+            if self.pad_mels:
+                # The vocoder is inefficient on short mels, so the mels are padded
+                # with silence to a bucketed length.
+                mel_length = mel_outputs.shape[-1]
+                target = max(
+                    self.MIN_MEL_LENGTH,
+                    -(-mel_length // self.MEL_BUCKET_SIZE) * self.MEL_BUCKET_SIZE,
+                )
+                mel_outputs = F.pad(
+                    mel_outputs,
+                    (0, target - mel_length),
+                    value=mel_outputs.min().item(),
+                )
+
+            # Running Vocoder (spectrogram-to-waveform)
+            mel_outputs = mel_outputs.to(self.hifi_gan.device)
+            waveforms = self.hifi_gan.decode_batch(mel_outputs)
+
+        hop_length = waveforms.shape[-1] // mel_outputs.shape[-1]
+        waveforms = self._to_host(waveforms.squeeze(1))
+        mel_lengths = mel_lengths.cpu().tolist()
+
+        results = []
+        for waveform, mel_length in zip(waveforms, mel_lengths):
+            # Strip the audio that was generated from the batch padding
+            results.append(self._to_int16(waveform[: int(mel_length) * hop_length]))
+        return results
+
+    def _to_host(self, waveforms):
+        """Copies the waveforms to the CPU and returns them as a float32 numpy
+        ndarray. On CUDA, the waveforms are copied into a reused pinned buffer
+        that doubles in size whenever it is too small. The returned array is a
+        view of that buffer and only valid until the next call."""
+        if waveforms.device.type != "cuda":
+            return waveforms.float().numpy()
+        n = waveforms.numel()
+        if self._host_buf is None or self._host_buf.numel() < n:
+            size = self._host_buf.numel() if self._host_buf is not None else 1
+            while size < n:
+                size *= 2
+            self._host_buf = torch.empty(size, dtype=torch.float32, pin_memory=True)
+        host = self._host_buf[:n].view(waveforms.shape)
+        host.copy_(waveforms, non_blocking=True)
+        torch.cuda.synchronize(waveforms.device)
+        return host.numpy()
 
+    @staticmethod
+    def _to_int16(waveform):
+        """Converts float32 data [-1,1] to int16 data [-32767,32767]. Values
+        outside of [-1,1] are clipped instead of wrapping around. Without numba,
+        the float32 data is modified in place. NaNs are converted to 0."""
+        if _f32_to_i16 is not None:
+            out = np.empty(waveform.shape[0], dtype=np.int16)
+            _f32_to_i16(np.ascontiguousarray(waveform, dtype=np.float32), out)
+            waveform = out
+        else:
+            np.nan_to_num(waveform, copy=False, nan=0.0)
+            np.clip(waveform, -1.0, 1.0, out=waveform)
+            np.multiply(waveform, 32767.0, out=waveform)
+            np.rint(waveform, out=waveform)
+            waveform = waveform.astype(np.int16)
+        # Cached arrays are shared between callers and must not be altered.
+        waveform.flags.writeable = False
         return waveform
 
 
@@ -111,7 +394,12 @@ class SpeechBrainTTSModule(retico_core.AbstractModule):
     }
 
     def __init__(
-        self, language="en", dispatch_on_finish=True, frame_duration=0.2, **kwargs
+        self,
+        language="en",
+        dispatch_on_finish=True,
+        frame_duration=0.2,
+        batch_size=4,
+        **kwargs
     ):
         super().__init__(**kwargs)
 
@@ -126,17 +414,33 @@ class SpeechBrainTTSModule(retico_core.AbstractModule):
             hifi_model=self.LANGUAGE_MAPPING[language]["hifi_model"],
         )
         self.frame_duration = frame_duration
+        self.batch_size = batch_size
         self.samplerate = 22050  # samplerate of tts (fixed at 22050 for speechbrain)
         self.samplewidth = 2
         self._tts_thread_active = False
         self._latest_text = ""
+        self._current_text = ""
         self.latest_input_iu = None
-        self.audio_buffer = []
-        self.audio_pointer = 0
-        self.clear_after_finish = False
+        self._reset_stream()
+
+    def _reset_stream(self):
+        """Resets the audio stream and the state of the synthesis thread."""
+        # The audio stream is shared between the synthesis thread (the only
+        # writer of _stream) and the TTS thread (the only writer of _playback).
+        # Both are immutable tuples that are swapped atomically, so no locks are
+        # needed. _stream holds the wave, the stream id, whether an utterance
+        # in it has finished and the offset at which the current utterance
+        # starts in the wave.
+        self._stream = (np.empty(0, dtype=np.int16), 0, False, 0)
+        self._playback = (0, 0)
+        self._synth_q = queue.Queue()
+        self._utterance = 0
+        self._generation = 0
+        self._utterance_generation = {}
+        self._synth_stop = threading.Event()
 
     def current_text(self):
-        return " ".join(iu.text for iu in self.current_input)
+        return self._current_text
 
     def process_update(self, update_message):
         if not update_message:
@@ -146,69 +450,179 @@ class SpeechBrainTTSModule(retico_core.AbstractModule):
             if ut == retico_core.UpdateType.ADD:
                 self.current_input.append(iu)
                 self.latest_input_iu = iu
+                if len(self.current_input) == 1:
+                    self._current_text = iu.text
+                else:
+                    self._current_text += " " + iu.text
             elif ut == retico_core.UpdateType.REVOKE:
                 self.revoke(iu)
+                self._current_text = " ".join(iu.text for iu in self.current_input)
+                # The synthesized prefix is no longer valid, so the next
+                # synthesis has to start from the beginning of the utterance.
+                self._latest_text = ""
             elif ut == retico_core.UpdateType.COMMIT:
                 final = True
         current_text = self.current_text()
-        if final or (
-            len(current_text) - len(self._latest_text) > 15
-            and not self.dispatch_on_finish
-        ):
+        new_text = current_text[len(self._latest_text) :].strip()
+        if final or (len(new_text) > 15 and not self.dispatch_on_finish):
+            # Only the text that was added since the last synthesis is
+            # synthesized and appended to the audio of the prefix.
+            append = bool(self._latest_text)
             self._latest_text = current_text
-            chunk_size = int(self.samplerate * self.frame_duration)
-            chunk_size_bytes = chunk_size * self.samplewidth
-            new_audio = self.tts.synthesize(current_text)
-            new_buffer = []
-            i = 0
-            while i < len(new_audio):
-                chunk = new_audio[i : i + chunk_size_bytes]
-                if len(chunk) < chunk_size_bytes:
-                    chunk = chunk + b"\x00" * (chunk_size_bytes - len(chunk))
-                new_buffer.append(chunk)
-                i += chunk_size_bytes
-            if self.clear_after_finish:
-                self.audio_buffer.extend(new_buffer)
-            else:
-                self.audio_buffer = new_buffer
+            self._request_synthesis(new_text, final, append)
         if final:
-            self.clear_after_finish = True
             self.current_input = []
+            self._current_text = ""
+            self._latest_text = ""
+            self._utterance += 1
+
+    def _request_synthesis(self, text, final, append):
+        """Hands the text over to the synthesis thread. A request that replaces
+        the audio supersedes all pending syntheses of the current utterance,
+        which are dropped from the queue. Syntheses of previous utterances are
+        always kept.
+
+        Args:
+            text (str): The text to synthesize.
+            final (bool): Whether the text is the final text of the utterance.
+            append (bool): Whether the audio should be appended to the audio of
+                the previous synthesis instead of replacing it.
+        """
+        if not append:
+            self._generation += 1
+            self._utterance_generation[self._utterance] = self._generation
+            pending = []
+            while True:
+                try:
+                    pending.append(self._synth_q.get_nowait())
+                except queue.Empty:
+                    break
+            for item in pending:
+                if item is None or item[1] != self._utterance:
+                    self._synth_q.put(item)
+        self._synth_q.put((text, self._utterance, self._generation, final, append))
+
+    def _is_superseded(self, utterance, generation):
+        """Whether a newer request has replaced the audio of the utterance since
+        the request with the given generation was made."""
+        return generation < self._utterance_generation.get(utterance, 0)
+
+    def _synthesis_thread(self, synth_q, stop):
+        # The queue and the event are passed in, so that a thread that was shut
+        # down does not pick up the queue of a restarted module.
+        while not stop.is_set():
+            # Collect all pending requests (up to the batch size) so that they
+            # can be synthesized in one pass. None only wakes the thread up.
+            items = [synth_q.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(synth_q.get_nowait())
+                except queue.Empty:
+                    break
+            if stop.is_set():
+                break
+            items = [
+                item
+                for item in items
+                if item is not None and not self._is_superseded(*item[1:3])
+            ]
+            texts = [item[0] for item in items if item[0]]
+            try:
+                results = iter(self.tts.synthesize_batch(texts, as_array=True))
+            except Exception:
+                logger.exception("Synthesis of %r failed, dropping it.", texts)
+                for item in items:
+                    if item[3]:
+                        self._utterance_generation.pop(item[1], None)
+                continue
+
+            for text, utterance, generation, final, append in items:
+                if text:
+                    new_audio = next(results)
+                else:
+                    new_audio = np.empty(0, dtype=np.int16)
+                if self._is_superseded(utterance, generation):
+                    # The text has been superseded while it was synthesized.
+                    continue
+                self._publish(new_audio, final, append)
+                if final:
+                    # No more requests of this utterance can follow
+                    self._utterance_generation.pop(utterance, None)
+
+    def _publish(self, new_audio, final, append):
+        """Adds the synthesized audio to the audio stream. Audio that follows a
+        finished utterance is appended to it, unless the finished utterance has
+        been fully played. Then a new stream is started. Replacing audio only
+        replaces the audio of the current utterance.
+
+        Args:
+            new_audio (np.ndarray): The int16-encoded audio.
+            final (bool): Whether the audio ends the utterance.
+            append (bool): Whether the audio should be appended to the stream
+                instead of replacing it.
+        """
+        wave, stream_id, finished, start = self._stream
+        if finished:
+            played_id, played = self._playback
+            if played_id == stream_id and played >= len(wave):
+                wave = np.empty(0, dtype=np.int16)
+                stream_id += 1
+                finished = False
+                start = 0
+        if append:
+            wave = np.concatenate((wave, new_audio))
+        elif start:
+            wave = np.concatenate((wave[:start], new_audio))
+        else:
+            wave = new_audio
+        if final:
+            # The next utterance starts after the audio of this one
+            start = len(wave)
+        self._stream = (wave, stream_id, final or finished, start)
 
     def _tts_thread(self):
-        t1 = time.time()
+        chunk_size = int(self.samplerate * self.frame_duration)
+        silence = b"\x00" * self.samplewidth * chunk_size
+        next_tick = time.monotonic()
         while self._tts_thread_active:
-            t2 = t1
-            t1 = time.time()
-            if t1 - t2 < self.frame_duration:
-                time.sleep(self.frame_duration)
+            # Sleep until an absolute deadline so that the timing does not drift
+            next_tick += self.frame_duration
+            dt = next_tick - time.monotonic()
+            if dt > 0:
+                time.sleep(dt)
             else:
-                time.sleep(max((2 * self.frame_duration) - (t1 - t2), 0))
-
-            if self.audio_pointer >= len(self.audio_buffer):
-                raw_audio = (
-                    b"\x00"
-                    * self.samplewidth
-                    * int(self.samplerate * self.frame_duration)
-                )
-                if self.clear_after_finish:
-                    self.audio_pointer = 0
-                    self.audio_buffer = []
-                    self.clear_after_finish = False
+                # We are late, skip the missed deadlines instead of catching up
+                next_tick = time.monotonic()
+
+            wave, stream_id = self._stream[:2]
+            played_id, start = self._playback
+            if stream_id != played_id:
+                start = 0
+            if start >= len(wave):
+                raw_audio = silence
             else:
-                raw_audio = self.audio_buffer[self.audio_pointer]
-                self.audio_pointer += 1
+                raw_audio = wave[start : start + chunk_size].tobytes()
+                if len(raw_audio) < len(silence):
+                    # Pad the last frame of the audio with silence
+                    raw_audio += silence[len(raw_audio) :]
+                start += chunk_size
+            self._playback = (stream_id, start)
             iu = self.create_iu(self.latest_input_iu)
             iu.set_audio(raw_audio, 1, self.samplerate, self.samplewidth)
             um = retico_core.UpdateMessage.from_iu(iu, retico_core.UpdateType.ADD)
             self.append(um)
 
     def prepare_run(self):
-        self.audio_pointer = 0
-        self.audio_buffer = []
+        self._reset_stream()
         self._tts_thread_active = True
-        self.clear_after_finish = False
+        threading.Thread(
+            target=self._synthesis_thread,
+            args=(self._synth_q, self._synth_stop),
+            daemon=True,
+        ).start()
         threading.Thread(target=self._tts_thread).start()
 
     def shutdown(self):
         self._tts_thread_active = False
+        self._synth_stop.set()
+        self._synth_q.put(None)
@@ -39,6 +39,10 @@ config = {
         "numpy~=1.23",
         "torch~=1.12",
     ],
+    "extras_require": {
+        "blake3": ["blake3"],
+        "numba": ["numba"],
+    },
     "packages": find_packages(),
     "name": "retico-speechbraintts",
     "classifiers": [
@@ -0,0 +1,324 @@
+import collections
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import retico_core
+
+from retico_speechbraintts import speechbraintts
+from retico_speechbraintts.speechbraintts import SpeechBrainTTS, SpeechBrainTTSModule
+
+
+def audio(text):
+    """Returns the audio that the stub TTS synthesizes for the given text."""
+    return np.array([ord(c) for c in text], dtype=np.int16)
+
+
+class StubTTS:
+    """Synthesizes every character of a text as one sample. If `gate` is given,
+    the first synthesis blocks until it is set."""
+
+    def __init__(self, gate=None, fail_first=False):
+        self.gate = gate
+        self.fail_first = fail_first
+        self.started = threading.Event()
+        self.calls = []
+
+    def synthesize_batch(self, texts, as_array=False):
+        self.calls.append(list(texts))
+        if len(self.calls) == 1:
+            self.started.set()
+            if self.gate is not None:
+                self.gate.wait(5)
+            if self.fail_first:
+                raise RuntimeError("synthesis failed")
+        return [audio(text) for text in texts]
+
+
+def make_module(tts=None):
+    module = SpeechBrainTTSModule.__new__(SpeechBrainTTSModule)
+    module.tts = tts if tts is not None else StubTTS()
+    module.batch_size = 4
+    module._reset_stream()
+    return module
+
+
+def start_worker(module):
+    thread = threading.Thread(
+        target=module._synthesis_thread,
+        args=(module._synth_q, module._synth_stop),
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+
+def stop_worker(module, thread):
+    module._synth_stop.set()
+    module._synth_q.put(None)
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition was not met in time"
+        time.sleep(0.01)
+
+
+def test_publish_replace_and_append():
+    module = make_module()
+    module._publish(audio("ab"), False, False)
+    module._publish(audio("cd"), False, True)
+    wave, stream_id, finished, _ = module._stream
+    assert np.array_equal(wave, audio("abcd"))
+    assert stream_id == 0 and not finished
+
+    module._publish(audio("xy"), False, False)
+    wave, stream_id, finished, _ = module._stream
+    assert np.array_equal(wave, audio("xy"))
+    assert stream_id == 0 and not finished
+
+
+def test_publish_appends_to_unplayed_finished_stream():
+    module = make_module()
+    module._publish(audio("ab"), True, False)
+    module._playback = (0, 1)
+    module._publish(audio("cd"), False, False)
+    wave, stream_id, finished, _ = module._stream
+    assert np.array_equal(wave, audio("abcd"))
+    assert stream_id == 0 and finished
+
+
+def test_publish_replaces_only_current_utterance_of_unplayed_stream():
+    module = make_module()
+    module._publish(audio("ab"), True, False)
+    module._playback = (0, 1)
+    module._publish(audio("cd"), False, False)
+    module._publish(audio("cX"), False, False)
+    module._publish(audio("e"), True, True)
+    wave, stream_id, finished, start = module._stream
+    assert np.array_equal(wave, audio("abcXe"))
+    assert stream_id == 0 and finished and start == 5
+
+
+def test_publish_starts_new_stream_after_playback():
+    module = make_module()
+    module._publish(audio("ab"), True, False)
+    module._playback = (0, 2)
+    module._publish(audio("cd"), False, False)
+    wave, stream_id, finished, _ = module._stream
+    assert np.array_equal(wave, audio("cd"))
+    assert stream_id == 1 and not finished
+
+
+def test_replace_drops_pending_requests_of_current_utterance():
+    module = make_module()
+    module._request_synthesis("first", False, False)
+    module._request_synthesis("second", False, False)
+    assert [item[0] for item in module._synth_q.queue] == ["second"]
+
+    module._request_synthesis("done", True, True)
+    module._utterance += 1
+    module._request_synthesis("next", False, False)
+    assert [item[0] for item in module._synth_q.queue] == ["second", "done", "next"]
+
+
+def test_superseded_synthesis_is_not_published_after_commit():
+    gate = threading.Event()
+    module = make_module(StubTTS(gate=gate))
+    thread = start_worker(module)
+    try:
+        module._request_synthesis("stale", False, False)
+        assert module.tts.started.wait(5)
+        # The partial text is revoked and the utterance is committed while the
+        # stale text is still being synthesized.
+        module._request_synthesis("fresh", False, False)
+        module._request_synthesis("end", True, True)
+        module._utterance += 1
+        gate.set()
+        wait_for(lambda: module._stream[2])
+    finally:
+        stop_worker(module, thread)
+
+    wave, stream_id, finished, _ = module._stream
+    assert np.array_equal(wave, audio("freshend"))
+    assert stream_id == 0 and finished
+    assert module._utterance_generation == {}
+
+
+def test_synthesis_thread_survives_failed_batch():
+    gate = threading.Event()
+    module = make_module(StubTTS(gate=gate, fail_first=True))
+    thread = start_worker(module)
+    try:
+        module._request_synthesis("broken", False, False)
+        assert module.tts.started.wait(5)
+        module._request_synthesis("works", True, True)
+        gate.set()
+        wait_for(lambda: module._stream[2])
+    finally:
+        stop_worker(module, thread)
+
+    assert np.array_equal(module._stream[0], audio("works"))
+
+
+def test_restart_stops_old_synthesis_thread():
+    module = make_module()
+    old_thread = start_worker(module)
+    module._synth_stop.set()
+    module._synth_q.put(None)
+    # Restart before the old thread has woken up.
+    module._reset_stream()
+    old_thread.join(5)
+    assert not old_thread.is_alive()
+
+
+def make_incremental_module(dispatch_on_finish=False):
+    module = make_module()
+    module.dispatch_on_finish = dispatch_on_finish
+    module.current_input = []
+    module.latest_input_iu = None
+    module._latest_text = ""
+    module._current_text = ""
+    module.revoke = lambda iu: module.current_input.remove(iu)
+    return module
+
+
+def queued(module):
+    """Returns the (text, append, final) of all queued synthesis requests."""
+    return [(item[0], item[4], item[3]) for item in module._synth_q.queue]
+
+
+ADD = retico_core.UpdateType.ADD
+REVOKE = retico_core.UpdateType.REVOKE
+COMMIT = retico_core.UpdateType.COMMIT
+
+
+def test_process_update_synthesizes_only_new_suffix():
+    module = make_incremental_module()
+    module.process_update([(SimpleNamespace(text="hello"), ADD)])
+    module.process_update([(SimpleNamespace(text="world"), ADD)])
+    assert module.current_text() == "hello world"
+    assert queued(module) == []
+
+    module.process_update([(SimpleNamespace(text="again and again"), ADD)])
+    module.process_update([(SimpleNamespace(text="and more words here"), ADD)])
+    assert module.current_text() == "hello world again and again and more words here"
+    module.process_update([(SimpleNamespace(text="end"), COMMIT)])
+    assert queued(module) == [
+        ("hello world again and again", False, False),
+        ("and more words here", True, False),
+        ("", True, True),
+    ]
+    assert module.current_text() == ""
+    assert module._utterance == 1
+
+
+def test_process_update_revoke_restarts_synthesis():
+    module = make_incremental_module()
+    fox = SimpleNamespace(text="the quick brown fox")
+    module.process_update([(SimpleNamespace(text="so"), ADD), (fox, ADD)])
+    assert queued(module) == [("so the quick brown fox", False, False)]
+
+    module.process_update([(fox, REVOKE)])
+    assert module.current_text() == "so"
+    module.process_update([(SimpleNamespace(text="the quick brown cat"), ADD)])
+    assert module.current_text() == "so the quick brown cat"
+    # The revoked synthesis is superseded by the synthesis of the whole text
+    assert queued(module) == [("so the quick brown cat", False, False)]
+
+
+def test_process_update_dispatch_on_finish():
+    module = make_incremental_module(dispatch_on_finish=True)
+    module.process_update([(SimpleNamespace(text="a rather long first part"), ADD)])
+    assert queued(module) == []
+    module.process_update(
+        [
+            (SimpleNamespace(text="and the end"), ADD),
+            (SimpleNamespace(text=""), COMMIT),
+        ]
+    )
+    assert queued(module) == [("a rather long first part and the end", False, True)]
+
+
+def test_pcm_kernel_matches_numpy_fallback(monkeypatch):
+    pytest.importorskip("numba")
+    rng = np.random.default_rng(0)
+    ties = (np.arange(-20, 20, dtype=np.float32) + np.float32(0.5)) / np.float32(
+        32767.0
+    )
+    special = np.array(
+        [np.nan, np.inf, -np.inf, 2.0, -2.0, 1.0, -1.0, 0.0], dtype=np.float32
+    )
+    waveform = np.concatenate(
+        (special, ties, rng.uniform(-1.2, 1.2, 10000).astype(np.float32))
+    )
+
+    kernel = SpeechBrainTTS._to_int16(waveform.copy())
+    monkeypatch.setattr(speechbraintts, "_f32_to_i16", None)
+    fallback = SpeechBrainTTS._to_int16(waveform.copy())
+
+    assert np.array_equal(kernel, fallback)
+    assert kernel[0] == 0
+
+
+def make_cache(tmp_path):
+    tts = SpeechBrainTTS.__new__(SpeechBrainTTS)
+    tts.caching = True
+    tts.caching_dir = str(tmp_path)
+    tts._cache_prefix = os.path.join(tts.caching_dir, "")
+    tts.mem_cache_size = 32
+    tts._mem_cache = collections.OrderedDict()
+    tts.refresh_cache_index()
+    return tts
+
+
+def test_cache_lookup_of_valid_and_empty_files(tmp_path):
+    audio("abc").tofile(str(tmp_path / "valid"))
+    (tmp_path / "empty").write_bytes(b"")
+    tts = make_cache(tmp_path)
+
+    assert np.array_equal(tts._lookup("valid"), audio("abc"))
+    empty = tts._lookup("empty")
+    assert empty is not None and len(empty) == 0
+    assert tts._lookup("missing") is None
+
+
+def test_cache_lookup_drops_corrupt_and_removed_files(tmp_path):
+    (tmp_path / "odd").write_bytes(b"\x00\x01\x02")
+    (tmp_path / "removed").write_bytes(b"\x00\x01")
+    tts = make_cache(tmp_path)
+    os.remove(str(tmp_path / "removed"))
+
+    assert tts._lookup("odd") is None
+    assert tts._lookup("removed") is None
+    assert "odd" not in tts._cached and "removed" not in tts._cached
+    assert "odd" not in tts._mem_cache
+
+
+def test_cache_write(tmp_path):
+    tts = make_cache(tmp_path)
+    tts._write_cache("digest", audio("abc"))
+
+    assert os.listdir(str(tmp_path)) == ["digest"]
+    assert "digest" in tts._cached
+    assert np.array_equal(tts._lookup("digest"), audio("abc"))
+
+
+def test_failed_cache_write_removes_temp_file(tmp_path, monkeypatch):
+    tts = make_cache(tmp_path)
+
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        tts._write_cache("digest", audio("abc"))
+
+    assert os.listdir(str(tmp_path)) == []
+    assert "digest" not in tts._cached